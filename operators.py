@@ -683,7 +683,7 @@ def populate_lists(context: bpy.types.Context):
 def populate_model_list(context: bpy.types.Context):
     res_path = context.scene.res_file
     scene = context.scene
-    res = ResFile(res_path)
+    res = ResFile(res_path, use_index=True)
     bpy.context.scene.model_list.clear()
     files = res.get_model_list()
     for file in files:
@@ -694,7 +694,7 @@ def populate_model_list(context: bpy.types.Context):
 def populate_animation_list(context: bpy.types.Context):
     scene = context.scene
     res_path = scene.res_file
-    res = ResFile(res_path)
+    res = ResFile(res_path, use_index=True)
     scene.animation_list.clear()
     model_name = scene.figmodel_name
     try:
@@ -818,22 +818,22 @@ class CModelImport(bpy.types.Operator):
             return {'CANCELLED'}
 
         reload_modules()
-        res = ResFile(res_path)
-        model_name = self.model_name or self.get_model_name(context)
-        if not model_name:
-            self.report({'ERROR'}, 'Model/Figure name is empty')
-            return self.null_result(res, model_name)
+        with ResFile(res_path, use_mmap=True, use_index=True, lock=True) as res:
+            model_name = self.model_name or self.get_model_name(context)
+            if not model_name:
+                self.report({'ERROR'}, 'Model/Figure name is empty')
+                return self.null_result(res, model_name)
 
-        mesh_mask = self.mesh_mask
-        mesh_mask_set = set(map(str.strip, mesh_mask.split(','))) if mesh_mask else None
+            mesh_mask = self.mesh_mask
+            mesh_mask_set = set(map(str.strip, mesh_mask.split(','))) if mesh_mask else None
 
-        bpy.context.window_manager.progress_begin(0, 99)
-        func = lambda: scene_utils.import_model(context, res, model_name, mesh_mask_set)
-        result, duration = call_with_time(func)
-        bpy.context.window_manager.progress_end()
+            bpy.context.window_manager.progress_begin(0, 99)
+            func = lambda: scene_utils.import_model(context, res, model_name, mesh_mask_set)
+            result, duration = call_with_time(func)
+            bpy.context.window_manager.progress_end()
 
-        if result is None:
-            return self.null_result(res, model_name)
+            if result is None:
+                return self.null_result(res, model_name)
 
         self.report({'INFO'}, f'Done in {duration:.2f} sec')
         return {'FINISHED'}
@@ -933,58 +933,58 @@ class CAnimationImport(bpy.types.Operator):
         reload_modules()
         anm_name = self.animation_name or scene.animation_name
         model_name = scene.figmodel_name
-        res_file = ResFile(res_path)
 
         if not model_name:
             self.report({'ERROR'}, 'Model/Figure name is empty')
             return {'CANCELLED'}
 
-        # choosing model to load
-        if model_name + '.anm' not in res_file.get_filename_list():
-            self.report({'ERROR'}, 'Animations set for ' + model_name + 'not found')
-            return {'CANCELLED'}
+        with ResFile(res_path, use_mmap=True, use_index=True, lock=True) as res_file:
+            # choosing model to load
+            if model_name + '.anm' not in res_file:
+                self.report({'ERROR'}, 'Animations set for ' + model_name + 'not found')
+                return {'CANCELLED'}
 
-        animations = res_file.get_animation_list(model_name + ".anm")
+            animations = res_file.get_animation_list(model_name + ".anm")
 
-        if not anm_name:
-            self.report({'ERROR'}, 'Animation name is empty')
+            if not anm_name:
+                self.report({'ERROR'}, 'Animation name is empty')
 
-        if anm_name not in animations:  # set of animations
-            self.report({'ERROR'}, 'Cannot find ' + anm_name + '\nAnimation list: ' + str(animations))
-            return {'CANCELLED'}
+            if anm_name not in animations:  # set of animations
+                self.report({'ERROR'}, 'Cannot find ' + anm_name + '\nAnimation list: ' + str(animations))
+                return {'CANCELLED'}
 
-        if not scene_utils.get_collection("base"):
-            self.report({'ERROR'}, 'No base collection exists in the scene.')
-            return {'CANCELLED'}
+            if not scene_utils.get_collection("base"):
+                self.report({'ERROR'}, 'No base collection exists in the scene.')
+                return {'CANCELLED'}
 
-        # fix names for base collection being imported
-        animation_destination_name = self.get_target_collection(context)
-        self.report({'INFO'}, f'Importing into "{animation_destination_name}" collection')
+            # fix names for base collection being imported
+            animation_destination_name = self.get_target_collection(context)
+            self.report({'INFO'}, f'Importing into "{animation_destination_name}" collection')
 
-        if animation_destination_name != "base":
-            scene_utils.copy_collection("base", animation_destination_name)
-            self.report({'INFO'}, f'Copying "base" collection as "{animation_destination_name}"')
+            if animation_destination_name != "base":
+                scene_utils.copy_collection("base", animation_destination_name)
+                self.report({'INFO'}, f'Copying "base" collection as "{animation_destination_name}"')
 
-        reload_modules()
-        self.report({'INFO'}, f'Renaming .001-like names for "{animation_destination_name}"')
+            reload_modules()
+            self.report({'INFO'}, f'Renaming .001-like names for "{animation_destination_name}"')
 
-        def do_import():
-            scene_utils.rename_drop_postfix(scene_utils.get_collection(animation_destination_name).objects)
-            animations = scene_utils.read_animations(res_file, model_name, anm_name)
-            links = scene_utils.collect_links(animation_destination_name)
-            scene_utils.ei2abs_rotations(links, animations)
+            def do_import():
+                scene_utils.rename_drop_postfix(scene_utils.get_collection(animation_destination_name).objects)
+                animations = scene_utils.read_animations(res_file, model_name, anm_name)
+                links = scene_utils.collect_links(animation_destination_name)
+                scene_utils.ei2abs_rotations(links, animations)
 
-            bAutofix = bpy.context.scene.animsubfix
-            if not bAutofix:
-                scene_utils.abs2Blender_rotations(links, animations)
+                bAutofix = bpy.context.scene.animsubfix
+                if not bAutofix:
+                    scene_utils.abs2Blender_rotations(links, animations)
 
-            scene_utils.insert_animation(animation_destination_name, animations)
-            context.scene.frame_set(0)
+                scene_utils.insert_animation(animation_destination_name, animations)
+                context.scene.frame_set(0)
 
-        _, duration = call_with_time(do_import)
+            _, duration = call_with_time(do_import)
 
-        self.report({'INFO'}, f'Done in {duration:.2f} sec')
-        return {'FINISHED'}
+            self.report({'INFO'}, f'Done in {duration:.2f} sec')
+            return {'FINISHED'}
 
 
 class CAnimationExport(bpy.types.Operator):
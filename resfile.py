@@ -1,11 +1,31 @@
+import bisect
 import copy
+import ctypes
+import errno
+import hashlib
 import io
+import itertools
+import marshal
+import mmap
 import os.path
+import shutil
 import struct
-from dataclasses import dataclass
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from typing import List, Optional
 
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks, ResFile(lock=True) does nothing
+    fcntl = None
+
 from .helpers import read_exactly
 
 _SIGNATURE_EI = 0x019CE23C
@@ -16,12 +36,69 @@ _TABLE_ENTRY_FORMAT_EI = '<lLLLHL'
 # Etherlords 2 GOG (RU) have slightly different format for .RES:
 # Evil islands -
 _TABLE_ENTRY_FORMAT_ETH2RU = '<lLHLL'
+# numpy counterparts of the table entry formats, for get_table_array()
+_TABLE_ENTRY_DTYPE_EI = np.dtype([
+    ('next_index', '<i4'), ('file_size', '<u4'), ('file_offset', '<u4'), ('modify_time', '<u4'),
+    ('name_length', '<u2'), ('name_offset', '<u4'),
+])
+_TABLE_ENTRY_DTYPE_ETH2RU = np.dtype([
+    ('next_index', '<i4'), ('file_size', '<u4'), ('name_length', '<u2'), ('file_offset', '<u4'),
+    ('name_offset', '<u4'),
+])
+_COPY_CHUNK_SIZE = 1 << 20
+# Nested archives up to this size are read with a single readinto() and parsed from memory
+_NESTED_BUFFER_LIMIT = 16 << 20
+# Sidecar cache of the decoded files table, see ResFile(use_index=True)
+_INDEX_SUFFIX = '.idx'
+_INDEX_VERSION = 1
+# Sidecar journal of earlier entry versions, see ResFile(journal=True)
+_JOURNAL_SUFFIX = '.jnl'
+_JOURNAL_VERSION = 1
+_JOURNAL_DEPTH = 4  # versions kept per entry
+# read_many() merges entries separated by gaps up to this size into one read, up to the read size limit
+_COALESCE_GAP = 64 << 10
+_COALESCE_READ_LIMIT = 8 << 20
+# fallocate() mode flags, see ResFile.punch_holes()
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def _load_fallocate():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
 
 
 class InvalidResFile(Exception):
     pass
 
 
+def _align(value, alignment=16):
+    return value + (alignment - value % alignment) % alignment
+
+
+def _find_holes(used_ranges):
+    # -> start, end of the aligned gaps before each of the used ranges, past the header
+    holes = []
+    data_end = _HEADER_SIZE
+    for start, end in sorted(used_ranges):
+        hole_start = _align(data_end)
+        if start > hole_start:
+            holes.append((hole_start, start))
+        data_end = max(data_end, end)
+    return holes
+
+
 @dataclass
 class ResFileItemInfo:
     name: str
@@ -30,6 +107,16 @@ class ResFileItemInfo:
     modify_time: Optional[datetime] = None
 
 
+@dataclass
+class ResFileVerifyReport:
+    errors: List[str] = field(default_factory=list)
+    checksums: dict[str, str] = field(default_factory=dict)  # entry path -> hex digest, see ResFile.verify()
+
+    @property
+    def ok(self):
+        return not self.errors
+
+
 class _ResSubFile(io.BufferedIOBase):
 
     def __init__(self, file: io.BufferedIOBase, mode, entry: ResFileItemInfo, close_cb):
@@ -39,18 +126,24 @@ class _ResSubFile(io.BufferedIOBase):
         self._entry = entry
         self._close_cb = close_cb
 
-        assert mode in ('r', 'w')
+        # 'a' is read/write access to an existing entry, it may grow only if nothing follows it
+        assert mode in ('r', 'w', 'a')
         self._file.seek(self._entry.file_offset)
 
     @property
     def mode(self):
         return self._mode
 
+    @property
+    def entry(self):
+        return self._entry
+
     def readable(self):
-        return self._mode == 'r'
+        # written entries may be read back when the archive file allows it
+        return self._mode in ('r', 'a') or self._file.readable()
 
     def writable(self):
-        return self._mode == 'w'
+        return self._mode in ('w', 'a')
 
     def read(self, size=-1):
         self._check_closed('read')
@@ -61,6 +154,16 @@ class _ResSubFile(io.BufferedIOBase):
 
         return self._file.read(min(size, self._entry.file_size - self.tell()))
 
+    def readinto(self, b):
+        self._check_closed('readinto')
+        if not self.readable():
+            raise io.UnsupportedOperation('file not open for reading')
+        target = memoryview(b).cast('B')
+        size = min(len(target), self._entry.file_size - self.tell())
+        if size <= 0:
+            return 0
+        return self._file.readinto(target[:size])
+
     def write(self, data):
         self._check_closed('write')
         if not self.writable():
@@ -108,13 +211,256 @@ class _ResSubFile(io.BufferedIOBase):
         if self.closed:  # pylint: disable=using-constant-test
             raise ValueError(f'{operation} on closed file')
 
-    def truncate(self):
-        pass
+    def truncate(self, size=None):
+        self._check_closed('truncate')
+        if not self.writable():
+            raise io.UnsupportedOperation('file not open for writing')
+        self._entry.file_size = self.tell() if size is None else size
+        return self._entry.file_size
+
+
+class _ResFileView(io.BufferedIOBase):
+    """
+    Read-only file over a memoryview of the archive (or of its entry).
+    read() returns a copy like a regular file, getbuffer() gives out the memoryview itself.
+    """
+
+    def __init__(self, buffer):
+        super().__init__()
+        view = memoryview(buffer)
+        if view.format != 'B' or view.ndim != 1:
+            view = view.cast('B')
+        self._buffer = view
+        self._pos = 0
+
+    @property
+    def mode(self):
+        return 'r'
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return bytes(self._read_view(size))
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def readinto(self, b):
+        target = memoryview(b).cast('B')
+        view = self._read_view(len(target))
+        target[:len(view)] = view
+        return len(view)
+
+    def getbuffer(self):
+        self._check_closed('getbuffer')
+        return self._buffer
+
+    def tell(self):
+        self._check_closed('tell')
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        self._check_closed('seek')
+        if whence == 0:
+            new_pos = pos
+        elif whence == 1:
+            new_pos = self._pos + pos
+        elif whence == 2:
+            new_pos = len(self._buffer) + pos
+        else:
+            raise ValueError('invalid whence value')
+        self._pos = min(max(new_pos, 0), len(self._buffer))
+        return self._pos
+
+    def _read_view(self, size):
+        self._check_closed('read')
+        end = len(self._buffer) if size is None or size < 0 else min(self._pos + size, len(self._buffer))
+        view = self._buffer[self._pos:end]
+        self._pos = end
+        return view
+
+    def _check_closed(self, operation):
+        if self.closed:  # pylint: disable=using-constant-test
+            raise ValueError(f'{operation} on closed file')
+
+
+class _ResReaderSubFile(io.BufferedIOBase):
+    """
+    Read-only subfile with its own position, reading through positional reads of the ResFile.
+    Any number of them may be opened at once and used from different threads.
+    """
+
+    def __init__(self, res: 'ResFile', entry: ResFileItemInfo):
+        super().__init__()
+        self._res = res
+        self._entry = entry
+        self._pos = 0
+
+    @property
+    def mode(self):
+        return 'r'
+
+    @property
+    def entry(self):
+        return self._entry
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        self._check_closed('read')
+        remaining = self._entry.file_size - self._pos
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        if size <= 0:
+            return b''
+        data = self._res._read_at(self._entry.file_offset + self._pos, size)
+        self._pos += len(data)
+        return bytes(data)
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def readinto(self, b):
+        self._check_closed('readinto')
+        target = memoryview(b).cast('B')
+        size = min(len(target), self._entry.file_size - self._pos)
+        if size <= 0:
+            return 0
+        size = self._res._read_into(self._entry.file_offset + self._pos, target[:size])
+        self._pos += size
+        return size
+
+    def tell(self):
+        self._check_closed('tell')
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        self._check_closed('seek')
+        if whence == 0:
+            new_pos = pos
+        elif whence == 1:
+            new_pos = self._pos + pos
+        elif whence == 2:
+            new_pos = self._entry.file_size + pos
+        else:
+            raise ValueError('invalid whence value')
+        self._pos = min(max(new_pos, 0), self._entry.file_size)
+        return self._pos
+
+    def _check_closed(self, operation):
+        if self.closed:  # pylint: disable=using-constant-test
+            raise ValueError(f'{operation} on closed file')
+
+
+class _ResSpooledSubFile(io.BytesIO):
+    """Subfile written into memory and stored into the ResFile on close, once its size is known."""
+
+    def __init__(self, close_cb):
+        super().__init__()
+        self._close_cb = close_cb
+
+    @property
+    def mode(self):
+        return 'w'
+
+    def close(self):
+        if self.closed:  # pylint: disable=using-constant-test
+            return
+        data = self.getvalue()
+        try:
+            super().close()
+        finally:
+            self._close_cb(data)
+
+
+def _read_whole(file) -> bytearray:
+    # Reads a subfile with readinto(), without intermediate copies
+    buffer = bytearray(file.entry.file_size)
+    view = memoryview(buffer)
+    file.seek(0)
+    filled = 0
+    while filled < len(buffer):
+        size = file.readinto(view[filled:])
+        if not size:
+            raise InvalidResFile('Unexpected EOF')
+        filled += size
+    return buffer
+
+
+def _get_source_date_epoch() -> int:
+    value = os.environ.get('SOURCE_DATE_EPOCH', '0')
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'SOURCE_DATE_EPOCH must be a unix time, got {value!r}') from None
+
+
+def _is_replaced(fileno, path) -> bool:
+    # the opened file isn't the one at path anymore
+    try:
+        return not os.path.samestat(os.fstat(fileno), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+
+def _open_exclusive(path):
+    # -> the file at path opened for reading, with an exclusive fcntl lock where available
+    while True:
+        file = open(path, 'rb')
+        if fcntl is None:
+            return file
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        if not _is_replaced(file.fileno(), path):
+            return file
+        file.close()
+
+
+def _get_fileno(file) -> Optional[int]:
+    try:
+        return file.fileno()
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
 
 
 class ResFile:
 
-    def __init__(self, file, mode='r'):
+    def __init__(self, file, mode='r', use_mmap=False, use_index=False, lazy=False, reuse_space=False,
+                 lock=False, deterministic=None, journal=False):
+        """
+        file may be a path, a file object, or a bytes-like object / entry opened from a mapped ResFile,
+        the latter are parsed in place without copying.
+        use_mmap maps the whole archive in read mode, so entries are given out as memoryview slices
+        and nested ResFiles over them don't copy data either.
+        use_index keeps the decoded files table in a '<path>.idx' file next to the archive, keyed on
+        the archive path, size and mtime, so reopening an unchanged archive skips table parsing.
+        lazy (read mode only) doesn't read the files table up front: entries are looked up by following
+        the archive's hash chains on disk, case-insensitively like the game does. The table is read
+        in full only when listing files.
+        reuse_space (append mode) places written entries into holes left by replaced or removed entries,
+        when one is big enough, instead of appending them. Such entries are kept in memory until closed.
+        Space freed during the session is reused only by the next one, as the table on disk still
+        refers to it.
+        lock takes an advisory fcntl lock on an archive opened by path, shared for reading, exclusive
+        for writing. In append mode the shared lock becomes exclusive on the first change, and the files
+        table is read again if another process changed it meanwhile, so several processes may add
+        entries to one archive. repack() and convert() hold the exclusive lock until they replace the file,
+        locked sessions then go on with the new one. Does nothing where fcntl isn't available.
+        deterministic makes the same writes give the same bytes: written entries get a fixed modify time,
+        SOURCE_DATE_EPOCH or 0 (no time), and the files table is built in name order. None turns it on
+        when SOURCE_DATE_EPOCH is set, as is usual for reproducible builds. It only applies to writing,
+        where a SOURCE_DATE_EPOCH that isn't a number raises ValueError.
+        journal keeps the last few versions of replaced or removed entries of an archive opened by path
+        in a '<path>.jnl' file, see rollback(). Their data is kept until the next repack: entries aren't
+        updated in place, free space reuse and hole punching leave it alone and compaction moves it along.
+        Once started, the journal is kept by all the sessions that open the archive by path.
+        """
         if mode not in ('r', 'w', 'a'):
             raise ValueError('ResFile requires mode "r", "w", "a"')
 
@@ -123,24 +469,99 @@ class ResFile:
         self._file = file if not self._opened else None
         self._mode = mode
         self._table: dict[str, ResFileItemInfo] = {}
+        self._table_loaded = True
+        self._table_header = None  # table_offset, table_size, names_size
+        self._lazy = lazy and mode == 'r'
+        self._reuse_space = reuse_space and mode != 'r'
+        self._free_ranges: list[tuple[int, int]] = []  # start, end of holes between entries
+        # start, end of the entries data and the files table that the header on disk refers to (append mode)
+        self._disk_ranges: set[tuple[int, int]] = set()
+        # earlier versions of entries by name, the latest one last, None without a journal
+        self._journal: Optional[dict[str, List[ResFileItemInfo]]] = None
+        self._journal_path = file + _JOURNAL_SUFFIX if self._opened else None
+        self._start_journal = journal and self._journal_path is not None
+        self._disk_table: dict[str, ResFileItemInfo] = {}  # entries on disk, journaled when superseded
+        self._data_end: Optional[int] = None  # append cursor, None when it has to be found again
+        # sorted names and names by extension, built on first use, None when names change
+        self._sorted_names: Optional[List[str]] = None
+        self._extension_names: Optional[dict[str, List[str]]] = None
+        self._nested: dict[str, ResFile] = {}  # parsed nested archives, see get_nested()
         self._subfile = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._buffer: Optional[memoryview] = None
+        self._path = file if self._opened else None
+        self._index_path = file + _INDEX_SUFFIX if self._opened and use_index else None
+        self._file_lock: Optional[int] = None  # fcntl lock held on the archive, see lock
+        if deterministic is None:
+            deterministic = 'SOURCE_DATE_EPOCH' in os.environ
+        # modify time of written entries in deterministic mode, None for the current time
+        self._fixed_time: Optional[int] = _get_source_date_epoch() if deterministic and mode != 'r' else None
+        self._disk_table_key: Optional[bytes] = None  # header and table on disk, to see if they changed
+        use_lock = lock and self._opened and fcntl is not None
+
+        if isinstance(file, _ResFileView):
+            file = file.getbuffer()
+        elif (isinstance(file, (_ResSubFile, _ResReaderSubFile)) and self._mode == 'r' and file.mode == 'r'
+              and file.entry.file_size <= _NESTED_BUFFER_LIMIT):
+            # nested archive: one read of the parent entry instead of many small seeks and reads through it
+            file = _read_whole(file)
+        if isinstance(file, (bytes, bytearray, memoryview, mmap.mmap)):
+            if self._mode != 'r':
+                raise ValueError('ResFile over a buffer requires mode "r"')
+            self._file = _ResFileView(file)
+            self._buffer = self._file.getbuffer()
 
+        append = self._mode == 'a'
         if not self._file and self._mode == 'a':
             try:
                 self._file = open(file, 'rb+')
             except FileNotFoundError:
                 self._mode = 'w'
 
+        if not self._file and self._mode == 'w' and use_lock:
+            # truncated once locked
+            self._file = os.fdopen(os.open(file, os.O_RDWR | os.O_CREAT, 0o666), 'rb+')
         if not self._file:
             self._file = open(file, self._mode + 'b')
+        self._fileno = _get_fileno(self._file) if self._buffer is None else None
+        # files on disk are changed so that an interrupted write leaves the previous table in use,
+        # see _write_headers()
+        self._crash_safe = self._fileno is not None
+        self._lock = threading.Lock()
+        if use_lock:
+            self._lock_current_file(fcntl.LOCK_EX if self._mode == 'w' else fcntl.LOCK_SH)
+            if self._mode == 'a' and self._is_empty():
+                # created by another session that hasn't written it yet, it's new only for the holder
+                # of the exclusive lock
+                self._lock_current_file(fcntl.LOCK_EX)
+                if self._is_empty():
+                    self._mode = 'w'
+            elif append and self._mode == 'w' and not self._is_empty():
+                # created and written by another session while waiting for the lock
+                self._mode = 'a'
+            if self._mode == 'w':
+                self._file.truncate(0)
+
+        if use_mmap and self._mode == 'r' and self._buffer is None:
+            self._map_file()
 
         if self._mode in ('r', 'a'):
             self._read_headers()
+            self._load_journal()
+        elif self._start_journal:
+            self._journal = {}
+        if self._mode == 'a':
+            self._disk_ranges = self._get_disk_ranges()
+            if self._file_lock is not None:
+                self._disk_table_key = self._get_disk_table_key()
+        if self._reuse_space:
+            self._free_ranges = self._find_free_ranges()
 
     @classmethod
     def is_res_file(cls, bytes_):
-        sigbytes = bytes_[:4]
-        sig = struct.unpack('L', sigbytes)[0]
+        if len(bytes_) < 4:
+            return False
+        sig = struct.unpack_from('<L', bytes_)[0]
         return sig == _SIGNATURE_EI or sig == _SIGNATURE_ETH2RU
 
     def __enter__(self):
@@ -156,23 +577,214 @@ class ResFile:
             raise ValueError('only one opened file is allowed')
 
         if mode == 'r':
-            entry = self._table[name]
+            entry = self._get_entry(name)
+            if self._buffer is not None:
+                return _ResFileView(self._get_entry_buffer(entry))
         elif mode == 'w':
             if self._mode == 'r':
                 raise ValueError('ResFile was opened in read mode, so open() requires mode "r"')
+            self._begin_write()
+            self._drop_nested(name)
+            if self._reuse_space:
+                self._subfile = _ResSpooledSubFile(lambda data: self._close_spooled_subfile(name, data))
+                return self._subfile
             self._write_alignment()
-            entry = ResFileItemInfo(name, 0, max(_HEADER_SIZE, self._file.tell()), datetime.now())
-            self._table[name] = entry
+            entry = ResFileItemInfo(name, 0, max(_HEADER_SIZE, self._file.tell()), self._now())
+            self._set_entry(entry)
         else:
             raise ValueError('open() requires mode "r" or "w"')
 
         self._subfile = _ResSubFile(self._file, mode, entry, self._close_subfile)
         return self._subfile
 
+    def remove(self, name):
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._mode == 'r':
+            raise ValueError('ResFile was opened in read mode, remove() is not allowed')
+        self._begin_write()
+        self._drop_nested(name)
+        entry = self._table.pop(name)
+        self._drop_names_index()
+        if entry.file_offset + entry.file_size >= self._get_data_end():
+            self._data_end = None
+
+    def write_nested(self, path, data):
+        """
+        Replaces or adds one entry of a nested archive, e.g. 'unhuma.anm/attack' or 'unhuma.anm/attack/lh1'.
+        Only the entry and the nested tables are written: the nested archive grows in place, after being
+        moved to the end of data once if something follows it or the header on disk refers to its data.
+        Missing nested archives are created.
+        """
+        self._update_nested(
+            'write_nested', path, lambda nested, nested_path: nested._write_entry_or_nested(nested_path, data))
+
+    def remove_nested(self, path):
+        """Removes one entry of a nested archive, like write_nested() only the nested tables are rewritten."""
+        self._update_nested(
+            'remove_nested', path, lambda nested, nested_path: nested._remove_entry_or_nested(nested_path))
+
+    def _update_nested(self, operation, path, update):
+        # update(nested, nested_path) is called on the nested archive opened for append
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._mode == 'r':
+            raise ValueError(f'ResFile was opened in read mode, {operation}() is not allowed')
+        if self._subfile:
+            raise ValueError('only one opened file is allowed')
+        container_name, _, nested_path = path.partition('/')
+        if not nested_path:
+            raise ValueError(f'{operation}() requires a path to an entry inside a nested archive')
+        self._begin_write()
+        self._drop_nested(container_name)
+
+        entry = self._table.get(container_name)
+        if entry is None:
+            if operation != 'write_nested':
+                raise KeyError(container_name)
+            with (
+                self.open(container_name, 'w') as container_file,
+                ResFile(container_file, 'w', deterministic=self._fixed_time is not None) as nested
+            ):
+                update(nested, nested_path)
+            return
+
+        if not self._is_tail_entry(entry):
+            self._move_to_end(entry)
+        entry.modify_time = self._now()
+        self._subfile = _ResSubFile(self._file, 'a', entry, self._close_subfile)
+        with (
+            self._subfile as container_file,
+            ResFile(container_file, 'a', reuse_space=True, deterministic=self._fixed_time is not None) as nested
+        ):
+            update(nested, nested_path)
+
+    def _write_entry_or_nested(self, path, data):
+        if '/' in path:
+            self.write_nested(path, data)
+        else:
+            with self.open(path, 'w') as file:
+                file.write(data)
+
+    def _remove_entry_or_nested(self, path):
+        if '/' in path:
+            self.remove_nested(path)
+        else:
+            self.remove(path)
+
+    def get_nested(self, path) -> 'ResFile':
+        """
+        Returns the nested archive at path like 'unhuma.anm' or 'unhuma.anm/attack'.
+        Nested archives are read through positional readers and cached with their parsed tables,
+        until their entry is rewritten or the ResFile is closed.
+        """
+        name, _, nested_path = path.partition('/')
+        nested = self._nested.get(name)
+        if nested is None:
+            nested = ResFile(self.open_reader(name))
+            self._nested[name] = nested
+        return nested.get_nested(nested_path) if nested_path else nested
+
+    def open_path(self, path):
+        """Opens entry at path like 'unhuma.anm/attack/lh1' for reading, see get_nested() and open_reader()."""
+        container_path, _, name = path.rpartition('/')
+        res = self.get_nested(container_path) if container_path else self
+        return res.open_reader(name)
+
+    def _drop_nested(self, name):
+        nested = self._nested.pop(name, None)
+        if nested is not None:
+            nested.close()
+
+    def write_files(self, files):
+        """Writes many (name, data) pairs in one session, each is appended at the cursor or put in a hole."""
+        for name, data in files:
+            with self.open(name, 'w') as file:
+                file.write(data)
+
+    def open_reader(self, name):
+        """
+        Opens an entry for reading with positional reads (os.pread where available), unlike open()
+        it doesn't share the file position, so readers may be used concurrently and from threads.
+        """
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        return self._open_entry_reader(self._get_entry(name))
+
+    def _open_entry_reader(self, entry: ResFileItemInfo):
+        if self._buffer is not None:
+            return _ResFileView(self._get_entry_buffer(entry))
+        return _ResReaderSubFile(self, copy.copy(entry))
+
+    def get_buffer(self, name) -> memoryview:
+        """Returns entry data as memoryview, without copying if the archive is mapped or a buffer."""
+        entry = self._get_entry(name)
+        if self._buffer is not None:
+            return self._get_entry_buffer(entry)
+        with self.open(name) as file:
+            return memoryview(file.read())
+
+    def read_many(self, names, max_gap=_COALESCE_GAP) -> dict:
+        """
+        Reads many entries at once and returns {name: memoryview}. Entries are read in file offset order,
+        neighbours separated by at most max_gap bytes are merged into one sequential read.
+        """
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        entries = sorted(((name, self._get_entry(name)) for name in names), key=lambda item: item[1].file_offset)
+        result = {}
+        index = 0
+        while index < len(entries):
+            start = entries[index][1].file_offset
+            end = start + entries[index][1].file_size
+            last = index + 1
+            while last < len(entries):
+                entry = entries[last][1]
+                entry_end = max(end, entry.file_offset + entry.file_size)
+                if entry.file_offset - end > max_gap or entry_end - start > _COALESCE_READ_LIMIT:
+                    break
+                end = entry_end
+                last += 1
+            data = memoryview(self._read_at(start, end - start))
+            for name, entry in entries[index:last]:
+                offset = entry.file_offset - start
+                result[name] = data[offset:offset + entry.file_size]
+            index = last
+        return result
+
+    def get_versions(self, name) -> List[ResFileItemInfo]:
+        """Returns the earlier versions of the entry kept in the journal, the latest one last."""
+        return copy.deepcopy(self._journal.get(name, [])) if self._journal else []
+
+    def rollback(self, name):
+        """
+        Makes the latest earlier version of the entry in the journal current again (append mode),
+        the current version is dropped. Only the files table changes, no data is copied.
+        """
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._mode != 'a':
+            raise ValueError('ResFile.rollback requires mode "a"')
+        if self._subfile:
+            raise ValueError('only one opened file is allowed')
+        self._begin_write()
+        versions = self._journal.get(name) if self._journal else None
+        if not versions:
+            raise KeyError(f'{name} has no earlier versions')
+        version = versions.pop()
+        if not versions:
+            del self._journal[name]
+        self._drop_nested(name)
+        self._set_entry(version)
+        # the version on disk is dropped, not journaled, the restored one is journaled once replaced
+        self._disk_table[name] = copy.copy(version)
+        self._data_end = None
+
     def get_info(self, name):
-        return copy.deepcopy(self._table[name])
+        return copy.deepcopy(self._get_entry(name))
 
     def iter_files(self):
+        self._load_table()
         for entry in self._table.values():
             yield copy.deepcopy(entry)
 
@@ -186,36 +798,435 @@ class ResFile:
                     raise ValueError("can't close the ResFile while there is an opened subfile")
                 self._close_subfile()
 
+            for name in list(self._nested):
+                self._drop_nested(name)
+
             if self._mode != 'r':
+                self._begin_write()
+                self._update_journal()
                 self._write_headers()
+                self._file.flush()
+                if self._index_path:
+                    self._write_index()
+                if self._journal is not None:
+                    self._write_journal()
+                elif self._journal_path and os.path.exists(self._journal_path):
+                    # ranges of a journal not kept by this session may have been reused
+                    os.remove(self._journal_path)
         finally:
+            self._unmap_file()
             if self._opened:
                 self._file.close()
             self._file = None
+            # the descriptor number may be given to another file
+            self._fileno = None
+
+    def _set_file_lock(self, operation):
+        fcntl.flock(self._fileno, operation)
+        self._file_lock = operation
+
+    def _lock_current_file(self, operation) -> bool:
+        # -> True if the archive had to be opened again, as a repack replaced the file at its path
+        # before the lock was taken
+        reopened = False
+        self._set_file_lock(operation)
+        while _is_replaced(self._fileno, self._path):
+            self._file.close()
+            self._file = open(self._path, 'rb' if self._mode == 'r' else 'rb+')
+            self._fileno = _get_fileno(self._file)
+            self._set_file_lock(operation)
+            reopened = True
+        return reopened
+
+    def _is_empty(self):
+        return os.fstat(self._fileno).st_size == 0
+
+    def _begin_write(self):
+        # the shared lock of append mode becomes exclusive before the first change, with the table
+        # read again if another process wrote or replaced the archive since it was read
+        if self._file_lock is None or self._file_lock == fcntl.LOCK_EX:
+            return
+        if self._lock_current_file(fcntl.LOCK_EX) or self._get_disk_table_key() != self._disk_table_key:
+            self._reload_table()
+
+    def _reload_table(self):
+        for name in list(self._nested):
+            self._drop_nested(name)
+        self._table = {}
+        self._drop_names_index()
+        self._data_end = None
+        self._read_headers()
+        self._disk_ranges = self._get_disk_ranges()
+        self._load_journal()
+        if self._reuse_space:
+            self._free_ranges = self._find_free_ranges()
+
+    def _get_journal_entries(self):
+        return itertools.chain.from_iterable(self._journal.values()) if self._journal else ()
+
+    def _get_kept_entries(self):
+        # entries and versions whose data has to stay: the table, the journal and, while journaling,
+        # the entries on disk that may join it
+        return itertools.chain(self._table.values(), self._get_journal_entries(), self._disk_table.values())
+
+    def _load_journal(self):
+        self._journal = self._read_journal()
+        if self._journal is None and self._start_journal and self._mode != 'r':
+            self._journal = {}
+        if self._journal is not None and self._mode != 'r':
+            self._disk_table = {name: copy.copy(entry) for name, entry in self._table.items()}
+
+    def _read_journal(self) -> Optional[dict[str, List[ResFileItemInfo]]]:
+        if not self._journal_path:
+            return None
+        try:
+            with open(self._journal_path, 'rb') as f:
+                version, key, versions = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != _JOURNAL_VERSION or key != self._get_index_key():
+            return None
+        journal = {}
+        for name, name_versions in versions.items():
+            journal[name] = [
+                ResFileItemInfo(name, file_size, file_offset, datetime.fromtimestamp(timestamp) if timestamp else None)
+                for file_offset, file_size, timestamp in name_versions
+            ]
+        return journal
+
+    def _update_journal(self):
+        # versions on disk of entries replaced or removed since are added to the journal
+        if self._journal is None:
+            return
+        for name, disk_entry in self._disk_table.items():
+            entry = self._table.get(name)
+            if entry is not None and entry.file_offset == disk_entry.file_offset \
+                    and entry.file_size == disk_entry.file_size:
+                continue
+            versions = self._journal.setdefault(name, [])
+            versions.append(disk_entry)
+            del versions[:-_JOURNAL_DEPTH]
+        self._disk_table = {name: copy.copy(entry) for name, entry in self._table.items()}
+
+    def _write_journal(self):
+        versions = {}
+        for name, name_versions in self._journal.items():
+            versions[name] = [
+                (e.file_offset, e.file_size, int(e.modify_time.timestamp()) if e.modify_time else 0)
+                for e in name_versions
+            ]
+        temp_path = self._journal_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                marshal.dump((_JOURNAL_VERSION, self._get_index_key(), versions), f)
+            os.replace(temp_path, self._journal_path)
+        except OSError as ex:
+            print('Failed to write ResFile journal', self._journal_path, ex)
+
+    def _get_disk_table_key(self) -> bytes:
+        header_data = self._read_at(0, _HEADER_SIZE)
+        signature, table_size, table_offset, names_size = struct.unpack(_HEADER_FORMAT, header_data)
+        table_entry_format = _TABLE_ENTRY_FORMAT_ETH2RU if signature == _SIGNATURE_ETH2RU else _TABLE_ENTRY_FORMAT_EI
+        table_data = self._read_at(table_offset, table_size * struct.calcsize(table_entry_format) + names_size)
+        return hashlib.sha1(header_data + table_data).digest()
+
+    def _map_file(self):
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            # not a real file or an empty one, keep regular reads
+            return
+        self._buffer = memoryview(self._mmap)
+
+    def _unmap_file(self):
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # entry views are still in use, the mapping goes away with the last of them
+                pass
+            self._mmap = None
+
+    def _get_entry_buffer(self, entry: ResFileItemInfo) -> memoryview:
+        return self._buffer[entry.file_offset:entry.file_offset + entry.file_size]
+
+    def _get_data_end(self):
+        if self._data_end is None:
+            self._data_end = self._get_kept_end()
+            if self._crash_safe and self._disk_ranges:
+                # data is appended past all that the header on disk refers to, its table included
+                self._data_end = max(self._data_end, max(end for _, end in self._disk_ranges))
+        return self._data_end
+
+    def _get_kept_end(self):
+        return max((e.file_offset + e.file_size for e in self._get_kept_entries()), default=0)
 
     def _write_alignment(self):
-        end_of_files_data = (
-            max(e.file_offset + e.file_size for e in self._table.values())
-            if self._table else 0
-        )
-        self._file.seek(end_of_files_data)
+        self._file.seek(self._get_data_end())
         self._file.write(b'\0' * ((16 - self._file.tell() % 16) % 16))
 
     def _close_subfile(self):
         if self._subfile.mode != 'r':
+            entry_end = self._subfile.entry.file_offset + self._subfile.entry.file_size
+            if self._subfile.mode == 'a':
+                # only the last entry is opened for update, it may have shrunk
+                self._data_end = entry_end
+            else:
+                self._data_end = max(self._get_data_end(), entry_end)
             self._write_alignment()
         self._subfile = None
 
+    def _close_spooled_subfile(self, name, data):
+        self._subfile = None
+        offset = self._allocate(len(data))
+        if offset is None:
+            self._write_alignment()
+            offset = max(_HEADER_SIZE, self._file.tell())
+            self._data_end = offset + len(data)
+        self._file.seek(offset)
+        self._file.write(data)
+        self._set_entry(ResFileItemInfo(name, len(data), offset, self._now()))
+
+    def _now(self) -> Optional[datetime]:
+        if self._fixed_time is None:
+            return datetime.now()
+        return datetime.fromtimestamp(self._fixed_time) if self._fixed_time else None
+
+    def _is_tail_entry(self, entry):
+        # entry may grow in place: no other data follows or overlaps it, nor on disk, data that the header
+        # refers to, the entry's own included
+        if self._crash_safe and any(end > entry.file_offset for _, end in self._disk_ranges):
+            return False
+        return all(
+            e is entry or e.file_offset + e.file_size <= entry.file_offset
+            for e in self._get_kept_entries() if e.file_size
+        )
+
+    def _move_to_end(self, entry):
+        self._write_alignment()
+        new_offset = max(_HEADER_SIZE, self._file.tell())
+        self._copy_data(entry.file_offset, new_offset, entry.file_size)
+        entry.file_offset = new_offset
+        self._data_end = new_offset + entry.file_size
+
+    def _copy_data(self, src_offset, dst_offset, size):
+        # chunks go in increasing offsets, so the ranges may overlap if dst_offset < src_offset
+        copied = 0
+        while copied < size:
+            chunk = self._read_at(src_offset + copied, min(_COPY_CHUNK_SIZE, size - copied))
+            self._file.seek(dst_offset + copied)
+            self._file.write(chunk)
+            copied += len(chunk)
+
+    def _share_data(self, entry, original):
+        # entry was just appended, give up its data for the same data of original
+        if entry.file_offset + entry.file_size >= self._get_data_end():
+            self._data_end = entry.file_offset
+        entry.file_offset = original.file_offset
+
+    def _get_disk_ranges(self):
+        disk_ranges = {(e.file_offset, e.file_offset + e.file_size) for e in self._table.values() if e.file_size}
+        disk_ranges.add(self._get_disk_table_range())
+        return disk_ranges
+
+    def _get_disk_table_range(self):
+        _, table_size, table_offset, names_size = struct.unpack(_HEADER_FORMAT, self._read_at(0, _HEADER_SIZE))
+        return table_offset, table_offset + table_size * struct.calcsize(self._get_table_entry_format()) + names_size
+
+    def _find_free_ranges(self):
+        # holes between entries, that neither the table in memory, the one on disk nor the journal refer to
+        used_ranges = [(e.file_offset, e.file_offset + e.file_size) for e in self._get_kept_entries() if e.file_size]
+        return _find_holes(used_ranges + list(self._disk_ranges))
+
+    def compact(self, max_bytes=None) -> bool:
+        """
+        Moves entries from the end of data into holes before them (append mode), so the file is
+        truncated when closed. Like with reuse_space, only holes the table on disk doesn't refer to
+        are filled, so an interrupted compaction leaves the archive as it was, and the space of moved
+        entries is filled by a call in the next session. When no entry fits a hole, the first entry after
+        the lowest one is moved to the end of data, for the next session to fill the merged space.
+        max_bytes limits the data moved by one call, but at least one entry is moved.
+        Journaled versions are moved like entries. Returns True once no dead space is left between entries.
+        """
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._mode != 'a':
+            raise ValueError('ResFile.compact requires mode "a"')
+        if self._subfile:
+            raise ValueError('only one opened file is allowed')
+        self._begin_write()
+        # versions superseded so far have to move as well
+        self._update_journal()
+
+        # entries sharing data (see repack dedup) move together
+        ranges: dict[tuple[int, int], list[ResFileItemInfo]] = {}
+        for entry in itertools.chain(self._table.values(), self._get_journal_entries()):
+            if entry.file_size:
+                ranges.setdefault((entry.file_offset, entry.file_size), []).append(entry)
+
+        free_ranges = self._find_free_ranges()
+        moved = 0
+        for (file_offset, file_size), entries in sorted(ranges.items(), reverse=True):
+            # the lowest hole before the entry it fits in
+            index = next((i for i, (start, end) in enumerate(free_ranges)
+                          if start < file_offset and end - start >= file_size), None)
+            if index is None:
+                continue
+            if max_bytes is not None and moved and moved + file_size > max_bytes:
+                break
+            start, end = free_ranges[index]
+            self._copy_data(file_offset, start, file_size)
+            for entry in entries:
+                self._drop_nested(entry.name)
+                entry.file_offset = start
+            rest_start = _align(start + file_size)
+            if rest_start < end:
+                free_ranges[index] = (rest_start, end)
+            else:
+                del free_ranges[index]
+            moved += file_size
+
+        if not moved:
+            # no entry fits a hole: the one after the lowest hole goes to the end of data, the next session
+            # fills its space merged with the hole
+            entries = self._find_entries_after_hole(ranges.values())
+            if entries:
+                self._move_to_end(entries[0])
+                for entry in entries:
+                    self._drop_nested(entry.name)
+                    entry.file_offset = entries[0].file_offset
+                moved = entries[0].file_size
+
+        self._data_end = None
+        if self._journal is not None:
+            self._disk_table = {name: copy.copy(entry) for name, entry in self._table.items()}
+        if self._reuse_space:
+            self._free_ranges = self._find_free_ranges()
+        return not moved
+
+    def _find_entries_after_hole(self, groups):
+        # -> the entries sharing data that follow the lowest hole between entries, with the table on disk
+        # taken as used, None if there is no such hole. A hole followed only by the table is left to close(),
+        # that writes the new table there.
+        used_ranges = [(entries[0].file_offset, entries[0].file_offset + entries[0].file_size) for entries in groups]
+        for _, hole_end in _find_holes(used_ranges + [self._get_disk_table_range()]):
+            following = [entries for entries in groups if entries[0].file_offset >= hole_end]
+            if following:
+                return min(following, key=lambda entries: entries[0].file_offset)
+        return None
+
+    def punch_holes(self) -> int:
+        """
+        Releases the disk space of holes left by replaced or removed entries (append mode), with
+        fallocate(FALLOC_FL_PUNCH_HOLE) on Linux: no data moves and the holes read back as zeros.
+        Like with reuse_space, space freed in this session is released by the next one.
+        Returns the number of bytes punched, 0 where the system or file system doesn't support it.
+        """
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._mode != 'a':
+            raise ValueError('ResFile.punch_holes requires mode "a"')
+        if self._subfile:
+            raise ValueError('only one opened file is allowed')
+        self._begin_write()
+        if _fallocate is None or self._fileno is None:
+            return 0
+        self._file.flush()
+        punched = 0
+        for start, end in self._find_free_ranges():
+            if _fallocate(self._fileno, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, start, end - start) != 0:
+                error = ctypes.get_errno()
+                if error in (errno.EOPNOTSUPP, errno.ENOSYS):
+                    return punched
+                raise OSError(error, os.strerror(error))
+            punched += end - start
+        return punched
+
+    def _allocate(self, size) -> Optional[int]:
+        # best fit among the holes, None to append
+        if not size:
+            return None
+        best_index = None
+        for index, (start, end) in enumerate(self._free_ranges):
+            if end - start >= size and (best_index is None or end - start < self._range_size(best_index)):
+                best_index = index
+        if best_index is None:
+            return None
+
+        start, end = self._free_ranges[best_index]
+        rest_start = _align(start + size)
+        if rest_start < end:
+            self._free_ranges[best_index] = (rest_start, end)
+        else:
+            del self._free_ranges[best_index]
+        return start
+
+    def _range_size(self, index):
+        start, end = self._free_ranges[index]
+        return end - start
+
     def _read(self, size, message='Unexpected EOF'):
         try:
             return read_exactly(self._file, size)
         except Exception as ex:
             raise InvalidResFile(message) from ex
 
+    def _read_at(self, offset, size):
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._buffer is not None:
+            return self._buffer[offset:offset + size]
+        if self._fileno is not None and hasattr(os, 'pread'):
+            if self._mode != 'r':
+                self._file.flush()
+            return self._pread(offset, size)
+        with self._lock:
+            # keep the position of an opened subfile
+            pos = self._file.tell()
+            try:
+                self._file.seek(offset)
+                return self._read(size)
+            finally:
+                self._file.seek(pos)
+
+    def _read_into(self, offset, view):
+        if not self._file:
+            raise ValueError('ResFile is closed')
+        if self._buffer is not None:
+            data = self._buffer[offset:offset + len(view)]
+        elif self._fileno is not None and hasattr(os, 'preadv'):
+            if self._mode != 'r':
+                self._file.flush()
+            return os.preadv(self._fileno, [view], offset)
+        else:
+            data = self._read_at(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def _pread(self, offset, size):
+        chunks = []
+        while size > 0:
+            data = os.pread(self._fileno, size, offset)
+            if not data:
+                raise InvalidResFile('Unexpected EOF')
+            chunks.append(data)
+            offset += len(data)
+            size -= len(data)
+        return b''.join(chunks)
+
     def _lower_ascii(self, value):
         return ''.join((c.lower() if ord(c) < 128 else c) for c in value)
 
+    def _hash_name(self, name):
+        return sum(self._lower_ascii(name).encode('cp1251')) % (1 << 32)
+
     def _read_headers(self):
+        if self._index_path and self._read_index():
+            return
+
         self._file.seek(0)
         header_data = self._read(_HEADER_SIZE, 'File header is truncated')
         signature, table_size, table_offset, names_size = struct.unpack(_HEADER_FORMAT, header_data)
@@ -232,16 +1243,32 @@ class ResFile:
         table_data_size = table_size * table_entry_size
         if table_offset + table_data_size + names_size > res_file_size:
             raise InvalidResFile('Files table is truncated')
+        self._table_header = table_offset, table_size, names_size
+        if self._lazy:
+            self._table_loaded = False
+            return
         self._read_table(table_offset, table_data_size, names_size)
 
+        if self._index_path:
+            self._write_index()
+
+    def _get_table_header(self):
+        # -> table_offset, table_size, names_size, the header is read here if the table came from the index
+        if self._table_header is None:
+            _, table_size, table_offset, names_size = struct.unpack(
+                _HEADER_FORMAT, self._read_at(0, _HEADER_SIZE)
+            )
+            self._table_header = table_offset, table_size, names_size
+        return self._table_header
+
     def _get_table_entry_format(self):
         signature = self._signature
         table_entry_format = _TABLE_ENTRY_FORMAT_ETH2RU if signature == _SIGNATURE_ETH2RU else _TABLE_ENTRY_FORMAT_EI
         return table_entry_format
 
     def _read_table(self, table_offset, table_data_size, names_size):
-        self._file.seek(table_offset)
-        tables_data = self._read(table_data_size)
+        data = self._read_at(table_offset, table_data_size + names_size)
+        tables_data = data[:table_data_size]
         # print('%x', tables_data)
         # for i in range(5):
         #     offset = i*18
@@ -249,33 +1276,195 @@ class ResFile:
         #     data = tables_data[offset:offset2]
         #     print(data.hex())
         table_entry_format = self._get_table_entry_format()
-        names_data = self._read(names_size)
+        names_data = data[table_data_size:]
+        names, sizes, offsets, timestamps = [], [], [], []
         for table_entry in struct.iter_unpack(table_entry_format, tables_data):
-            modify_timestamp = None
-            if self._signature == _SIGNATURE_EI:
-                _, file_size, file_offset, modify_timestamp, name_length, name_offset = table_entry
-            else:
-                _, file_size, name_length, file_offset, name_offset = table_entry
+            _, file_size, file_offset, modify_timestamp, name_length, name_offset = \
+                self._decode_table_entry(table_entry)
             # print(_, file_size, name_length, file_offset, name_offset)
-            name = names_data[name_offset:name_offset + name_length].decode('cp1251')
-            modify_time = datetime.fromtimestamp(modify_timestamp) if modify_timestamp else None
+            names.append(str(names_data[name_offset:name_offset + name_length], 'cp1251'))
+            sizes.append(file_size)
+            offsets.append(file_offset)
+            timestamps.append(modify_timestamp)
+        self._fill_table(names, sizes, offsets, timestamps)
+
+    def _decode_table_entry(self, table_entry):
+        # -> next_index, file_size, file_offset, modify_timestamp, name_length, name_offset
+        if self._signature == _SIGNATURE_EI:
+            return table_entry
+        next_index, file_size, name_length, file_offset, name_offset = table_entry
+        return next_index, file_size, file_offset, 0, name_length, name_offset
+
+    def _load_table(self):
+        if self._table_loaded:
+            return
+        table_offset, table_size, names_size = self._table_header
+        table_data_size = table_size * struct.calcsize(self._get_table_entry_format())
+        # entries looked up so far are read again, in the table order
+        self._table = {}
+        self._read_table(table_offset, table_data_size, names_size)
+        self._table_loaded = True
+
+    def _get_entry(self, name) -> ResFileItemInfo:
+        entry = self._table.get(name)
+        if entry is None and not self._table_loaded:
+            entry = self._lookup_entry(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry
+
+    def _lookup_entry(self, name) -> Optional[ResFileItemInfo]:
+        # Follow the on-disk hash chain of the name, as written by _write_headers
+        table_offset, table_size, names_size = self._table_header
+        table_entry_format = self._get_table_entry_format()
+        table_entry_size = struct.calcsize(table_entry_format)
+        names_offset = table_offset + table_size * table_entry_size
+        lower_name = self._lower_ascii(name)
+        try:
+            name_hash = self._hash_name(name)
+        except UnicodeEncodeError:
+            # no name in the archive can have characters outside of cp1251
+            return None
+
+        index = name_hash % table_size if table_size else -1
+        for _ in range(table_size):
+            if not 0 <= index < table_size:
+                break
+            table_entry = struct.unpack(
+                table_entry_format, self._read_at(table_offset + index * table_entry_size, table_entry_size)
+            )
+            next_index, file_size, file_offset, modify_timestamp, name_length, name_offset = \
+                self._decode_table_entry(table_entry)
+            if name_offset + name_length <= names_size:
+                entry_name = str(self._read_at(names_offset + name_offset, name_length), 'cp1251')
+                if self._lower_ascii(entry_name) == lower_name:
+                    entry = ResFileItemInfo(
+                        name=entry_name, file_size=file_size, file_offset=file_offset,
+                        modify_time=datetime.fromtimestamp(modify_timestamp) if modify_timestamp else None,
+                    )
+                    self._table[entry_name] = entry
+                    return entry
+            index = next_index
+        return None
+
+    def _fill_table(self, names, sizes, offsets, timestamps):
+        # entries written together share timestamps, so convert each one once
+        times = {0: None}
+        for name, file_size, file_offset, modify_timestamp in zip(names, sizes, offsets, timestamps):
+            if modify_timestamp not in times:
+                times[modify_timestamp] = datetime.fromtimestamp(modify_timestamp)
             self._table[name] = ResFileItemInfo(
-                name=name, file_size=file_size, file_offset=file_offset, modify_time=modify_time
+                name=name, file_size=file_size, file_offset=file_offset, modify_time=times[modify_timestamp]
             )
+        self._drop_names_index()
+
+    def _set_entry(self, entry: ResFileItemInfo):
+        if entry.name not in self._table:
+            self._drop_names_index()
+        self._table[entry.name] = entry
+
+    def _drop_names_index(self):
+        self._sorted_names = None
+        self._extension_names = None
+
+    def _build_names_index(self):
+        if self._sorted_names is not None:
+            return
+        self._load_table()
+        self._sorted_names = sorted(self._table)
+        self._extension_names = {}
+        for name in self._table:
+            self._extension_names.setdefault(os.path.splitext(name)[1], []).append(name)
+
+    def _get_index_key(self):
+        stat = os.fstat(self._file.fileno())
+        return os.path.normcase(os.path.abspath(self._path)), stat.st_size, stat.st_mtime_ns
+
+    def _read_index(self) -> bool:
+        try:
+            with open(self._index_path, 'rb') as f:
+                version, key, signature, names, sizes, offsets, timestamps = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if version != _INDEX_VERSION or key != self._get_index_key():
+            return False
+        self._signature = signature
+        self._fill_table(names, sizes, offsets, timestamps)
+        return True
+
+    def _write_index(self):
+        entries = list(self._table.values())
+        index = (
+            _INDEX_VERSION,
+            self._get_index_key(),
+            self._signature,
+            [e.name for e in entries],
+            [e.file_size for e in entries],
+            [e.file_offset for e in entries],
+            [int(e.modify_time.timestamp()) if e.modify_time else 0 for e in entries],
+        )
+        # write through a temporary file, so other readers never see a partial index
+        temp_path = self._index_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                marshal.dump(index, f)
+            os.replace(temp_path, self._index_path)
+        except OSError as ex:
+            print('Failed to write ResFile index', self._index_path, ex)
 
     def _write_headers(self):
         # if (self._signature == _SIGNATURE_ETH2RU):
         #     raise Exception('Not supported: Write for ETH_2_RU .res')
         # Write any underlying .res as EI res.
-        self._write_alignment()
-        table_offset = self._file.tell()
+        table_data, names_data = self._build_table()
+        tables_size = len(table_data) + len(names_data)
+        if self._crash_safe:
+            # the table on disk stays valid until the header is switched to the new one
+            table_offset = self._find_table_offset(tables_size)
+            self._file.seek(table_offset)
+        else:
+            self._write_alignment()
+            table_offset = self._file.tell()
+        self._file.write(table_data)
+        self._file.write(names_data)
+        self._sync()
 
+        # Update file header, a single small write
+        self._file.seek(0)
+        data = struct.pack(_HEADER_FORMAT, _SIGNATURE_EI, len(self._table), table_offset, len(names_data))
+        self._file.write(data)
+        self._sync()
+        # only then the previous table and data no entry uses are cut off
+        self._file.truncate(max(self._get_kept_end(), table_offset + tables_size))
+        self._signature = _SIGNATURE_EI
+
+    def _find_table_offset(self, size):
+        # the first hole past all entries that neither the journal nor the header on disk use, else past them
+        # all; a table between entries would leave a hole there that no entry may fill, see compact()
+        kept_end = self._get_kept_end()
+        for start, end in self._find_free_ranges():
+            if start >= kept_end and end - start >= size:
+                return start
+        return _align(max(self._get_data_end(), _HEADER_SIZE))
+
+    def _sync(self):
+        self._file.flush()
+        if self._crash_safe:
+            os.fsync(self._fileno)
+
+    def _build_table(self, fill_time=True):
+        # -> hash table and names data, in EI format; entries with no modify time get the current one
+        # if fill_time, 0 otherwise
         # Build hash table
         hash_table = [[None, -1] for _ in self._table]  # entry, next_index
         last_free_index = len(hash_table) - 1
-        for entry in self._table.values():
+        # the slots depend on the order entries come in
+        entries = self._table.values()
+        if self._fixed_time is not None:
+            entries = sorted(entries, key=lambda e: e.name)
+        for entry in entries:
             # Calculate entry's hash
-            entry_hash = sum(b for b in self._lower_ascii(entry.name).encode('cp1251')) % (1 << 32)
+            entry_hash = self._hash_name(entry.name)
             index = entry_hash % len(hash_table)
 
             # If index is busy, find another one
@@ -293,73 +1482,550 @@ class ResFile:
             # Put entry in the hash table
             hash_table[index][0] = entry
 
-        # Write hash table
+        # Pack hash table
+        table_data = []
         encoded_names = []
         name_offset = 0
         table_entry_format = _TABLE_ENTRY_FORMAT_EI
         for entry, next_index in hash_table:
             encoded_names.append(entry.name.encode('cp1251'))
             name_length = len(encoded_names[-1])
-            modify_time = entry.modify_time or datetime.now()
+            modify_time = entry.modify_time or (self._now() if fill_time else None)
             data = struct.pack(
                 table_entry_format,
                 next_index,
                 entry.file_size,
                 entry.file_offset,
-                int(modify_time.timestamp()),
+                int(modify_time.timestamp()) if modify_time else 0,
                 name_length,
                 name_offset,
             )
             name_offset += name_length
-            self._file.write(data)
-
-        # Write file names
-        self._file.write(b''.join(encoded_names))
-        self._file.truncate()
-
-        # Update file header
-        self._file.seek(0)
-        data = struct.pack(_HEADER_FORMAT, _SIGNATURE_EI, len(hash_table), table_offset, name_offset)
-        self._file.write(data)
+            table_data.append(data)
+        return b''.join(table_data), b''.join(encoded_names)
+
+    def get_table_array(self) -> np.ndarray:
+        """
+        Returns the files table as a numpy structured array with 'name' (cp1251 bytes), 'file_size',
+        'file_offset' and 'modify_time' (unix time, 0 if unknown) fields, decoded from the raw table
+        with no Python object per entry. Entries come in the hash table order. In write and append modes
+        the table is built from the entries in memory instead.
+        """
+        if self._mode == 'r':
+            # the table on disk is unchanged, even if it was loaded from the index
+            table_offset, table_size, names_size = self._get_table_header()
+            entry_dtype = _TABLE_ENTRY_DTYPE_ETH2RU if self._signature == _SIGNATURE_ETH2RU else _TABLE_ENTRY_DTYPE_EI
+            table_data = self._read_at(table_offset, table_size * entry_dtype.itemsize + names_size)
+        else:
+            # table changed in memory
+            entry_dtype = _TABLE_ENTRY_DTYPE_EI
+            table_data, names_data = self._build_table(fill_time=False)
+            table_size = len(self._table)
+            table_data += names_data
+        table = np.frombuffer(table_data, dtype=entry_dtype, count=table_size)
+        names = np.frombuffer(table_data, dtype=np.uint8, offset=table_size * entry_dtype.itemsize)
+
+        # gather names into fixed width rows, zero padded past each name length
+        name_lengths = table['name_length'].astype(np.intp)
+        max_length = max(int(name_lengths.max(initial=0)), 1)
+        columns = np.arange(max_length)
+        mask = columns < name_lengths[:, None]
+        name_chars = np.zeros((table_size, max_length), dtype=np.uint8)
+        name_chars[mask] = names[(table['name_offset'].astype(np.intp)[:, None] + columns)[mask]]
+
+        result = np.empty(table_size, dtype=[
+            ('name', f'S{max_length}'), ('file_size', '<u4'), ('file_offset', '<u4'), ('modify_time', '<u4'),
+        ])
+        result['name'] = name_chars.view(f'S{max_length}').ravel()
+        result['file_size'] = table['file_size']
+        result['file_offset'] = table['file_offset']
+        result['modify_time'] = table['modify_time'] if 'modify_time' in entry_dtype.names else 0
+        return result
 
     def get_filename_list(self) -> List[str]:
+        self._load_table()
         return list(self._table.keys())
 
+    def __contains__(self, name):
+        try:
+            self._get_entry(name)
+        except KeyError:
+            return False
+        return True
+
+    def get_prefixed_list(self, prefix) -> List[str]:
+        """Returns sorted names starting with prefix."""
+        self._build_names_index()
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        end = start
+        while end < len(self._sorted_names) and self._sorted_names[end].startswith(prefix):
+            end += 1
+        return self._sorted_names[start:end]
+
+    def get_extension_list(self, extension) -> List[str]:
+        """Returns names with extension like '.mod', in the table order."""
+        self._build_names_index()
+        return list(self._extension_names.get(extension, ()))
+
     def get_model_list(self) -> List[str]:
         model_list = []
-        for name in self.get_filename_list():
-            file_ext = os.path.splitext(name)[1]
-            if file_ext in {'.mod', '.lnk'}:
+        for file_ext in ('.mod', '.lnk'):
+            for name in self.get_extension_list(file_ext):
                 model_list.append(name.rsplit('.')[0])
         return model_list
 
     def get_animation_list(self, model_name) -> List[str]:
-        with self.open(model_name, "r") as animation_container:
-            anm_res_file = ResFile(animation_container)
-            animations = anm_res_file.get_filename_list()
-        return animations
+        return self.get_nested(model_name).get_filename_list()
 
-    def get_valid_data(self, recursive=True):
+    def get_valid_data(self, recursive=True, dedup=False):
         # reread all res file entries and return them bytes
-        datas = []
-        fnames = self.get_filename_list()
-        fnames.sort()
-        for fname in fnames:
-            with self.open(fname, 'r') as f:
-                data = f.read()
-            if ResFile.is_res_file(data):
-                print("adding resfile", fname)
-                if recursive:
-                    buffer = io.BytesIO(data)
-                    with ResFile(buffer, "r") as internal_res:
-                        data = internal_res.get_valid_data(recursive)
-            else:
-                print("adding file", fname)
-            datas.append((fname, data))
-
         output = io.BytesIO()
         with ResFile(output, 'w') as res:
-            for fname, data in datas:
-                with res.open(fname, "w") as f:
-                    f.write(data)
+            _copy_entries(self, res, recursive, dedup)
         return output.getvalue()
+
+    def verify(self, recursive=True, checksum=None, threads=None) -> ResFileVerifyReport:
+        """
+        Checks the files table as it is on disk: names and entries out of bounds, entries overlapping
+        each other or the table, duplicate names and broken hash chains. recursive checks nested archives
+        the same way, checksum is a hashlib algorithm name like 'sha256' to hash every entry as well.
+        Entries are read and checked by a pool of threads (threads=None for the default size).
+        Problems are reported, not raised, with paths like 'unhuma.mod/unhumahd'.
+        """
+        if self._mode != 'r':
+            raise ValueError('ResFile.verify requires mode "r"')
+        report = ResFileVerifyReport()
+        entries = self._verify_table(report.errors)
+        if not recursive and checksum is None:
+            return report
+
+        def verify_entry(entry):
+            entry_report = ResFileVerifyReport()
+            try:
+                self._verify_entry(entry, entry_report, recursive, checksum)
+            except (InvalidResFile, OSError, ValueError) as ex:
+                entry_report.errors.append(f'{entry.name}: {ex}')
+            return entry_report
+
+        if threads == 1:
+            entry_reports = list(map(verify_entry, entries))
+        else:
+            with ThreadPoolExecutor(threads) as executor:
+                entry_reports = list(executor.map(verify_entry, entries))
+        for entry_report in entry_reports:
+            report.errors.extend(entry_report.errors)
+            report.checksums.update(entry_report.checksums)
+        return report
+
+    def _verify_table(self, errors) -> List[ResFileItemInfo]:
+        # -> entries with valid names and data bounds, to be read
+        signature, table_size, table_offset, names_size = struct.unpack(
+            _HEADER_FORMAT, self._read_at(0, _HEADER_SIZE))
+        if self._buffer is not None:
+            res_file_size = len(self._buffer)
+        else:
+            with self._lock:
+                pos = self._file.tell()
+                res_file_size = self._file.seek(0, 2)
+                self._file.seek(pos)
+        table_entry_format = self._get_table_entry_format()
+        table_entry_size = struct.calcsize(table_entry_format)
+        table_end = table_offset + table_size * table_entry_size + names_size
+        if table_offset < _HEADER_SIZE or table_end > res_file_size:
+            errors.append(f'files table is out of the file bounds: {table_offset:#x}-{table_end:#x}')
+            return []
+        data = self._read_at(table_offset, table_end - table_offset)
+        names_data = data[table_size * table_entry_size:]
+        table = [self._decode_table_entry(table_entry)
+                 for table_entry in struct.iter_unpack(table_entry_format, data[:table_size * table_entry_size])]
+
+        names = [None] * table_size
+        entries = []
+        for index, (next_index, file_size, file_offset, _, name_length, name_offset) in enumerate(table):
+            if name_offset + name_length > names_size:
+                errors.append(f'entry #{index}: name is out of the names bounds')
+                continue
+            try:
+                names[index] = str(names_data[name_offset:name_offset + name_length], 'cp1251')
+            except UnicodeDecodeError:
+                errors.append(f'entry #{index}: name is not cp1251')
+                continue
+            name = names[index]
+            if not -1 <= next_index < table_size:
+                errors.append(f'{name}: hash chain points out of the table')
+            if file_size and (file_offset < _HEADER_SIZE or file_offset + file_size > res_file_size):
+                errors.append(f'{name}: data is out of the file bounds')
+            elif file_size and file_offset < table_end and table_offset < file_offset + file_size:
+                errors.append(f'{name}: data overlaps the files table')
+            else:
+                entries.append(ResFileItemInfo(name, file_size, file_offset))
+
+        seen = {}
+        for name in names:
+            if name is not None and seen.setdefault(self._lower_ascii(name), name) is not name:
+                errors.append(f'{name}: duplicate name')
+
+        # entries with the same data are shared on purpose (see repack dedup), partial overlaps are not
+        last = None
+        for entry in sorted((e for e in entries if e.file_size), key=lambda e: (e.file_offset, e.file_size)):
+            if last is not None and entry.file_offset < last.file_offset + last.file_size and \
+                    (entry.file_offset, entry.file_size) != (last.file_offset, last.file_size):
+                errors.append(f'{entry.name}: data overlaps {last.name}')
+            if last is None or entry.file_offset + entry.file_size > last.file_offset + last.file_size:
+                last = entry
+
+        # every entry has to be found by following the chain from its hash slot, like lookups do
+        for index, name in enumerate(names):
+            if name is None:
+                continue
+            chain_index = self._hash_name(name) % table_size
+            visited = set()
+            while chain_index != index and 0 <= chain_index < table_size and chain_index not in visited:
+                visited.add(chain_index)
+                chain_index = table[chain_index][0]
+            if chain_index in visited:
+                errors.append(f'{name}: hash chain loops')
+            elif chain_index != index:
+                errors.append(f'{name}: not reachable from its hash chain')
+        return entries
+
+    def _verify_entry(self, entry: ResFileItemInfo, report: ResFileVerifyReport, recursive, checksum):
+        with self._open_entry_reader(entry) as file:
+            digest = hashlib.new(checksum) if checksum is not None else None
+            if recursive and _is_res_subfile(file):
+                if digest is not None:
+                    _copy_file(file, None, digest)
+                    file.seek(0)
+                with ResFile(file) as nested:
+                    nested_report = nested.verify(recursive, checksum, threads=1)
+                report.errors.extend(f'{entry.name}/{error}' for error in nested_report.errors)
+                report.checksums.update(
+                    (f'{entry.name}/{path}', value) for path, value in nested_report.checksums.items())
+            elif digest is not None:
+                _copy_file(file, None, digest)
+            if digest is not None:
+                report.checksums[entry.name] = digest.hexdigest()
+
+
+class ResOverlay:
+    """
+    Read-only view of several archives stacked over each other, like a mod over the base game,
+    res_files go from the highest priority to the lowest. Each name comes from the first archive that has it,
+    with one merged index built up front. Animations are merged by name as well: get_nested('unhuma.anm')
+    is an overlay of all the layers' 'unhuma.anm', while other nested archives like models come whole
+    from one layer. Closing the overlay closes the archives.
+    """
+
+    def __init__(self, res_files):
+        self._layers: List[ResFile] = list(res_files)
+        self._index: dict[str, ResFile] = {}  # name -> layer to read it from
+        for res in reversed(self._layers):
+            self._index.update(dict.fromkeys(res.get_filename_list(), res))
+        self._nested: dict[str, object] = {}  # see get_nested(), owned by the layers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        self._nested = {}
+        for res in self._layers:
+            res.close()
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def open(self, name, mode='r'):
+        if mode != 'r':
+            raise ValueError('ResOverlay is read-only, open() requires mode "r"')
+        return self._index[name].open(name)
+
+    def open_reader(self, name):
+        return self._index[name].open_reader(name)
+
+    def get_buffer(self, name) -> memoryview:
+        return self._index[name].get_buffer(name)
+
+    def get_info(self, name):
+        return self._index[name].get_info(name)
+
+    def read_many(self, names, max_gap=_COALESCE_GAP) -> dict:
+        """Same as ResFile.read_many(), names are read from each layer in one batch."""
+        layer_names: dict[ResFile, list] = {}
+        for name in names:
+            layer_names.setdefault(self._index[name], []).append(name)
+        result = {}
+        for res, res_names in layer_names.items():
+            result.update(res.read_many(res_names, max_gap))
+        return result
+
+    def get_nested(self, path):
+        name, _, nested_path = path.partition('/')
+        nested = self._nested.get(name)
+        if nested is None:
+            if name.endswith('.anm'):
+                nested = ResOverlay(res.get_nested(name) for res in self._layers if name in res)
+            else:
+                nested = self._index[name].get_nested(name)
+            self._nested[name] = nested
+        return nested.get_nested(nested_path) if nested_path else nested
+
+    def open_path(self, path):
+        container_path, _, name = path.rpartition('/')
+        res = self.get_nested(container_path) if container_path else self
+        return res.open_reader(name)
+
+    def get_filename_list(self) -> List[str]:
+        return list(self._index)
+
+    def get_extension_list(self, extension) -> List[str]:
+        return [name for name in self._index if os.path.splitext(name)[1] == extension]
+
+    def get_model_list(self) -> List[str]:
+        model_list = []
+        for file_ext in ('.mod', '.lnk'):
+            for name in self.get_extension_list(file_ext):
+                model_list.append(name.rsplit('.')[0])
+        return model_list
+
+    def get_animation_list(self, model_name) -> List[str]:
+        return self.get_nested(model_name).get_filename_list()
+
+
+def _is_res_subfile(file):
+    signature = file.read(4)
+    file.seek(0)
+    return ResFile.is_res_file(signature)
+
+
+def _copy_file(src_file, dst_file, digest=None):
+    # dst_file may be None to only hash src_file
+    while True:
+        chunk = src_file.read(_COPY_CHUNK_SIZE)
+        if not chunk:
+            break
+        if digest is not None:
+            digest.update(chunk)
+        if dst_file is not None:
+            dst_file.write(chunk)
+
+
+def _dedup_entry(res: ResFile, name, digest, stored):
+    # Points the entry just written at an earlier copy of the same content, if there is one,
+    # then the next write goes over its data
+    entry = res._table[name]
+    if not entry.file_size:
+        return
+    if digest is None:
+        digest = hashlib.sha256()
+        with res.open_reader(name) as file:
+            _copy_file(file, None, digest)
+    original = stored.setdefault((entry.file_size, digest.digest()), entry)
+    if original is not entry:
+        res._share_data(entry, original)
+
+
+def _copy_entries(src: ResFile, dst: ResFile, recursive, dedup=False):
+    # Copies live entries one at a time, nested archives are rebuilt the same way
+    stored = {}  # (size, digest) -> entry, for dedup
+    for name in sorted(src.get_filename_list()):
+        digest = hashlib.sha256() if dedup else None
+        with src.open_reader(name) as src_file, dst.open(name, 'w') as dst_file:
+            if recursive and _is_res_subfile(src_file):
+                # nested archive content is known only when written, it is hashed after that
+                digest = None
+                with ResFile(src_file) as nested_src, ResFile(dst_file, 'w') as nested_dst:
+                    _copy_entries(nested_src, nested_dst, recursive, dedup)
+            else:
+                _copy_file(src_file, dst_file, digest)
+        if dedup:
+            _dedup_entry(dst, name, digest, stored)
+
+
+def _repack_nested(path, name, file_offset, file_size, temp_dir, dedup):
+    # Process pool worker: repacks one nested archive of the file at path into a temporary file
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=temp_dir)
+    try:
+        with os.fdopen(fd, 'w+b') as temp_file, ResFile(path, lazy=True) as src:
+            entry = ResFileItemInfo(name, file_size, file_offset)
+            with (
+                _ResReaderSubFile(src, entry) as src_file,
+                ResFile(src_file) as nested_src,
+                ResFile(temp_file, 'w') as nested_dst
+            ):
+                _copy_entries(nested_src, nested_dst, True, dedup)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def _copy_entries_parallel(src: ResFile, dst: ResFile, path, processes, temp_dir, dedup):
+    # Nested archives are repacked by worker processes, then copied into dst in the usual order
+    names = sorted(src.get_filename_list())
+    futures = {}
+    stored = {}
+    with ProcessPoolExecutor(processes) as executor:
+        try:
+            for name in names:
+                with src.open_reader(name) as src_file:
+                    if _is_res_subfile(src_file):
+                        entry = src.get_info(name)
+                        futures[name] = executor.submit(
+                            _repack_nested, path, name, entry.file_offset, entry.file_size, temp_dir, dedup
+                        )
+
+            for name in names:
+                digest = hashlib.sha256() if dedup else None
+                with dst.open(name, 'w') as dst_file:
+                    if name in futures:
+                        temp_path = futures.pop(name).result()
+                        try:
+                            with open(temp_path, 'rb') as nested_file:
+                                _copy_file(nested_file, dst_file, digest)
+                        finally:
+                            os.remove(temp_path)
+                    else:
+                        with src.open_reader(name) as src_file:
+                            _copy_file(src_file, dst_file, digest)
+                if dedup:
+                    _dedup_entry(dst, name, digest, stored)
+        finally:
+            for future in futures.values():
+                if not future.cancel() and future.exception() is None:
+                    os.remove(future.result())
+
+
+def repack(path, recursive=True, processes=1, dedup=False):
+    """
+    Rewrites the archive without dead data. Entries are streamed one by one into a temporary file
+    next to the archive, which replaces it at the end, so memory use doesn't depend on the archive size.
+    With recursive, processes > 1 (None for one per CPU) repacks nested archives in that many worker
+    processes, meant for command line use, as the workers have to import this module outside of Blender.
+    dedup stores entries with identical content once, at each level, with all their names
+    pointing at the same data.
+    """
+    _repack_to(path, path, recursive, processes, dedup)
+
+
+def convert(src_path, dst_path, processes=1):
+    """
+    Writes the archive at src_path, in Evil Islands or Etherlords (ETH2RU) format, to dst_path
+    in Evil Islands format, nested archives included. It is streamed the same way as repack(),
+    with processes > 1 converting nested archives in parallel. Only the archive tables are converted,
+    other entries are copied as is.
+    """
+    _repack_to(src_path, dst_path, True, processes, False)
+
+
+def _repack_to(path, dst_path, recursive, processes, dedup):
+    # Streams the live entries of the archive at path into a temporary file that then replaces dst_path,
+    # which may be path itself
+    temp_dir = os.path.dirname(os.path.abspath(dst_path))
+    fd, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(dst_path) + '.', dir=temp_dir)
+    try:
+        # the exclusive lock is held until the file is replaced, so no locked session writes the archive
+        # meanwhile, and sessions waiting for it open the new file once they get it
+        with os.fdopen(fd, 'w+b') as temp_file, _open_exclusive(path) as src_file:
+            with ResFile(src_file, 'r') as src, ResFile(temp_file, 'w') as dst:
+                if recursive and processes != 1:
+                    _copy_entries_parallel(src, dst, path, processes, temp_dir, dedup)
+                else:
+                    _copy_entries(src, dst, recursive, dedup)
+            # Windows doesn't replace files that are open, there is no lock to keep either
+            temp_file.close()
+            if fcntl is None:
+                src_file.close()
+            # the temporary file is private to its owner, the archive keeps its permissions
+            shutil.copymode(dst_path if os.path.exists(dst_path) else path, temp_path)
+            os.replace(temp_path, dst_path)
+            if os.path.exists(dst_path + _JOURNAL_SUFFIX):
+                # the journal refers to the data of the replaced file
+                os.remove(dst_path + _JOURNAL_SUFFIX)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def verify(path, recursive=True, checksum=None, threads=None) -> ResFileVerifyReport:
+    """Checks the archive at path, see ResFile.verify(). An unreadable header is reported as well."""
+    try:
+        with ResFile(path, lazy=True) as res:
+            return res.verify(recursive, checksum, threads)
+    except InvalidResFile as ex:
+        return ResFileVerifyReport(errors=[str(ex)])
+
+
+def _same_content(file_a, file_b):
+    while True:
+        chunk = file_a.read(_COPY_CHUNK_SIZE)
+        if chunk != file_b.read(_COPY_CHUNK_SIZE):
+            return False
+        if not chunk:
+            return True
+
+
+def _diff_entries(old: ResFile, new: ResFile, patch: ResFile, prefix, recursive):
+    # Writes '-path' for removed entries and '+path' with the data of added or changed ones
+    new_names = set(new.get_filename_list())
+    for name in sorted(set(old.get_filename_list()) - new_names):
+        patch.open('-' + prefix + name, 'w').close()
+    for name in sorted(new_names):
+        with new.open_reader(name) as new_file:
+            if name in old:
+                with old.open_reader(name) as old_file:
+                    if old.get_info(name).file_size == new.get_info(name).file_size and \
+                            _same_content(old_file, new_file):
+                        continue
+                    old_file.seek(0)
+                    new_file.seek(0)
+                    if recursive and _is_res_subfile(old_file) and _is_res_subfile(new_file):
+                        with ResFile(old_file) as nested_old, ResFile(new_file) as nested_new:
+                            _diff_entries(nested_old, nested_new, patch, prefix + name + '/', recursive)
+                        continue
+            with patch.open('+' + prefix + name, 'w') as patch_file:
+                _copy_file(new_file, patch_file)
+
+
+def make_patch(old_path, new_path, patch_path, recursive=True):
+    """
+    Writes a patch from the archive at old_path to the one at new_path, itself a .res archive with
+    an entry per change: '+path' holds the data of an added or changed entry, '-path' marks a removed one.
+    With recursive, changed nested archives are diffed too, so paths may be like 'unhuma.mod/unhumahd'.
+    """
+    with ResFile(old_path) as old, ResFile(new_path) as new, ResFile(patch_path, 'w') as patch:
+        _diff_entries(old, new, patch, '', recursive)
+
+
+def apply_patch(path, patch_path):
+    """
+    Applies a patch made by make_patch() to the archive at path: entries are removed, then written in
+    the usual append mode, top level ones streamed from the patch, nested ones with write_nested().
+    """
+    with ResFile(patch_path) as patch, ResFile(path, 'a') as res:
+        names = patch.get_filename_list()
+        for name in sorted(name for name in names if name.startswith('-')):
+            res._remove_entry_or_nested(name[1:])
+        for name in sorted(name for name in names if name.startswith('+')):
+            entry_path = name[1:]
+            if '/' in entry_path:
+                res.write_nested(entry_path, patch.get_buffer(name))
+            else:
+                with patch.open_reader(name) as patch_file, res.open(entry_path, 'w') as file:
+                    _copy_file(patch_file, file)
+
+
+def punch_holes(path) -> int:
+    """Releases the disk space of dead data in the archive at path, see ResFile.punch_holes()."""
+    with ResFile(path, 'a') as res:
+        return res.punch_holes()
+
+
+def rollback(path, names):
+    """Rolls the entries of the archive at path back to their earlier versions, see ResFile.rollback()."""
+    with ResFile(path, 'a') as res:
+        for name in names:
+            res.rollback(name)
@@ -111,70 +111,65 @@ def read_links(lnk_res: ResFile, lnk_name: str):
     return lnk
 
 
-def read_figure(fig_res: ResFile, fig_name: str):
+def read_figure(fig_res: ResFile, fig_name: str, data=None):
     active_model: CModel = bpy.types.Scene.model
     err = 0
-    with fig_res.open(fig_name) as fig_res:
-        data = fig_res.read()
-        fig = CFigure()
-        err += fig.read_fig(fig_name, data)
-        active_model.mesh_list.append(fig)
+    if data is None:
+        data = fig_res.get_buffer(fig_name)
+    fig = CFigure()
+    err += fig.read_fig(fig_name, data)
+    active_model.mesh_list.append(fig)
     return err
 
 
-def read_bone(bon_res: ResFile, bon_name: str):
+def read_bone(bon_res: ResFile, bon_name: str, data=None):
     active_model: CModel = bpy.types.Scene.model
     err = 0
-    with bon_res.open(bon_name) as bon_res:
-        data = bon_res.read()
-        bon = CBone()
-        err += bon.read_bon(bon_name, data)
-        active_model.pos_list.append(bon)
+    if data is None:
+        data = bon_res.get_buffer(bon_name)
+    bon = CBone()
+    err += bon.read_bon(bon_name, data)
+    active_model.pos_list.append(bon)
     return err
 
 
 def read_model(res_file: ResFile, model_name, include_meshes=None):
-    with res_file.open(model_name + '.mod') as meshes_container:
-        mesh_list_res = ResFile(meshes_container)
-        links_name = model_name
-        links = read_links(mesh_list_res, links_name)
-        filenames = mesh_list_res.get_filename_list()
-        for mesh_name in filenames:
-            if mesh_name == links_name:
-                continue
-            if include_meshes and mesh_name not in include_meshes:
-                continue
-            read_figure(mesh_list_res, mesh_name)
-        return links
+    mesh_list_res = res_file.get_nested(model_name + '.mod')
+    links_name = model_name
+    links = read_links(mesh_list_res, links_name)
+    mesh_names = [mesh_name for mesh_name in mesh_list_res.get_filename_list()
+                  if mesh_name != links_name and (not include_meshes or mesh_name in include_meshes)]
+    mesh_data = mesh_list_res.read_many(mesh_names)
+    for mesh_name in mesh_names:
+        read_figure(mesh_list_res, mesh_name, mesh_data[mesh_name])
+    return links
 
 
 def read_bones(res_file: ResFile, model_name):
     err = 0
     # bones container
-    with res_file.open(model_name + '.bon') as bone_container:
-        bone_list_res = ResFile(bone_container)
-        for bone_name in bone_list_res.get_filename_list():
-            err += read_bone(bone_list_res, bone_name)
+    bone_list_res = res_file.get_nested(model_name + '.bon')
+    bone_names = bone_list_res.get_filename_list()
+    bone_data = bone_list_res.read_many(bone_names)
+    for bone_name in bone_names:
+        err += read_bone(bone_list_res, bone_name, bone_data[bone_name])
     return err
 
 
 def read_animations(res_file: ResFile, model_name: str, animation_name: str) -> CAnimations:
     anm_list = []
-    with res_file.open(model_name + '.anm') as animation_container:
-        anm_res_file = ResFile(animation_container)
-        with anm_res_file.open(animation_name) as animation_file:
-            animation_res = ResFile(animation_file)
-            for part_name in animation_res.get_filename_list():  # set of parts
-                with animation_res.open(part_name) as part_res:
-                    part = part_res.read()
-                    anm = CAnimation()
-                    anm.read_anm(part_name, part)
-                    # try:
-                    #     anm.read_anm(part_name, part)
-                    # except Exception as e:
-                    #     print('crash', e)
-                    #     continue
-                    anm_list.append(anm)
+    animation_res = res_file.get_nested(model_name + '.anm/' + animation_name)
+    for part_name in animation_res.get_filename_list():  # set of parts
+        with animation_res.open(part_name) as part_res:
+            part = part_res.read()
+            anm = CAnimation()
+            anm.read_anm(part_name, part)
+            # try:
+            #     anm.read_anm(part_name, part)
+            # except Exception as e:
+            #     print('crash', e)
+            #     continue
+            anm_list.append(anm)
     return CAnimations(anm_list)
 
 
@@ -213,19 +208,19 @@ def import_lnk_fig_bon_files(res_file, model_name, include_meshes=None):
         else:
             renamed_dict[active_model.name + part] = active_model.name + parent
     model_links.links = renamed_dict
-    # read parts
-    filenames = res_file.get_filename_list()
-    for part in model_links.links.keys():
-        if include_meshes and part not in include_meshes:
-            continue
-        if (part + '.fig') in filenames:
-            read_figure(res_file, part + '.fig')
+    # read parts, all their files at once in file order
+    parts = [part for part in model_links.links.keys() if not include_meshes or part in include_meshes]
+    part_data = res_file.read_many(
+        [part + ext for part in parts for ext in ('.fig', '.bon') if (part + ext) in res_file])
+    for part in parts:
+        if (part + '.fig') in res_file:
+            read_figure(res_file, part + '.fig', part_data[part + '.fig'])
             nnn = (active_model.mesh_list[-1].name.split(model_name)[1]).rsplit('.')[0]  # TODO: nnn
             active_model.mesh_list[-1].name = nnn
         else:
             print(part + '.fig not found')
-        if (part + '.bon') in filenames:
-            read_bone(res_file, part + '.bon')
+        if (part + '.bon') in res_file:
+            read_bone(res_file, part + '.bon', part_data[part + '.bon'])
         else:
             print(part + '.bon not found')
 
@@ -254,9 +249,9 @@ def create_model_meshes(links: CLink, include_meshes=None):
 
 
 def import_model(context, res_file, model_name, include_meshes: Set[str] = None):
-    if (model_name + '.mod') in res_file.get_filename_list():
+    if (model_name + '.mod') in res_file:
         import_mod_file(res_file, model_name, include_meshes)
-    elif (model_name + '.lnk') in res_file.get_filename_list():
+    elif (model_name + '.lnk') in res_file:
         import_lnk_fig_bon_files(res_file, model_name)
     else:
         return None
@@ -313,39 +308,34 @@ def export_model(context, res_path, model_name, include_meshes=None):
     #     with open(backup_path, "rb") as src:
     #         dst.write(src.read())
     if obj_count == 1:  # save lnk,fig,bon into res (without model resfile)
-        with ResFile(res_path, 'a') as res:
-            with res.open(active_model.name + '.lnk', 'w') as file:
-                data = links.write_lnk()
-                file.write(data)
-        # write figs
-        with ResFile(res_path, 'a') as res:
-            for mesh in active_model.mesh_list:
-                mesh.name = model_name + mesh.name + '.fig'
-                with res.open(mesh.name, 'w') as file:
-                    data = mesh.write_fig()
-                    file.write(data)
-        # write bones
-        with ResFile(res_path, 'a') as res:
-            for bone in active_model.pos_list:
-                bone.name = model_name + bone.name + '.bon'
-                with res.open(bone.name, 'w') as file:
-                    data = bone.write_bon()
-                    file.write(data)
-    else:
-        # append data
-        initial_model = None
-        initial_bone = None
-        if include_meshes:
-            with ResFile(res_path, 'r') as res:
-                with res.open(active_model.name + '.mod', 'r') as file:
-                    initial_model = file.read()
-                with res.open(active_model.name + '.bon', 'r') as file:
-                    initial_bone = file.read()
+        files = [(active_model.name + '.lnk', links.write_lnk())]
+        # figs
+        for mesh in active_model.mesh_list:
+            mesh.name = model_name + mesh.name + '.fig'
+            files.append((mesh.name, mesh.write_fig()))
+        # bones
+        for bone in active_model.pos_list:
+            bone.name = model_name + bone.name + '.bon'
+            files.append((bone.name, bone.write_bon()))
+        # single write session, the table is written once
+        with ResFile(res_path, 'a', reuse_space=True, lock=True, journal=True) as res:
+            res.write_files(files)
+    elif include_meshes:
+        # replace only the exported parts inside .mod and .bon containers
+        with ResFile(res_path, 'a', reuse_space=True, lock=True, journal=True) as res:
+            model_path = active_model.name + '.mod/'
+            res.write_nested(model_path + active_model.name, links.write_lnk())
+            for part in active_model.mesh_list:
+                res.write_nested(model_path + part.name, part.write_fig())
+            bone_path = active_model.name + '.bon/'
+            for part in active_model.pos_list:
+                res.write_nested(bone_path + part.name, part.write_bon())
 
+        print('resfile ' + res_path + ' saved')
+    else:
         # prepare links + figures (.mod file)
-        model_res = io.BytesIO(initial_model)
-        open_mode = 'a' if initial_model else 'w'
-        with ResFile(model_res, open_mode) as res:
+        model_res = io.BytesIO()
+        with ResFile(model_res, 'w') as res:
             # write lnk
             with res.open(active_model.name, 'w') as file:
                 data = links.write_lnk()
@@ -358,20 +348,21 @@ def export_model(context, res_path, model_name, include_meshes=None):
                     file.write(data)
 
         # prepare bons file (.bon file)
-        bone_res = io.BytesIO(initial_bone)
-        with ResFile(bone_res, open_mode) as res:
+        bone_res = io.BytesIO()
+        with ResFile(bone_res, 'w') as res:
             for part in active_model.pos_list:
                 with res.open(part.name, 'w') as file:
                     data = part.write_bon()
                     file.write(data)
 
-        with ResFile(res_path, 'a') as res:
+        with ResFile(res_path, 'a', reuse_space=True, lock=True, journal=True) as res:
             with res.open(active_model.name + '.mod', 'w') as file:
                 file.write(model_res.getvalue())
             with res.open(active_model.name + '.bon', 'w') as file:
                 file.write(bone_res.getvalue())
 
         print('resfile ' + res_path + ' saved')
+    compact_resfile(res_path)
     return without_morphs
 
 
@@ -1703,29 +1694,9 @@ def write_animations(animations, res_path, model_name, animation_name):
                 data = part.write_anm()
                 file.write(data)
 
-    # read all animation data(uattack, udeath and etc) from figures
-    export_model_name = model_name + '.anm'
-    data = {}
-    with (
-        ResFile(res_path, "r") as figres,
-        figres.open(export_model_name, "r") as anmfile,
-        ResFile(anmfile, "r") as res
-    ):
-        for info in res.iter_files():
-            with res.open(info.name) as file:
-                data[info.name] = file.read()
-
-    data[animation_name] = anm_res.getvalue()  # modified animation set
-
-    # write animations into res file
-    with (
-        ResFile(res_path, "a") as figres,
-        figres.open(export_model_name, "w") as anmfile,
-        ResFile(anmfile, "w") as res
-    ):
-        for name, anm_data in data.items():
-            with res.open(name, "w") as file:
-                file.write(anm_data)
+    # replace the animation set (uattack, udeath and etc) inside model animations
+    with ResFile(res_path, "a", reuse_space=True, lock=True, journal=True) as figres:
+        figres.write_nested(model_name + '.anm/' + animation_name, anm_res.getvalue())
 
     print(res_path + 'saved')
 
@@ -1853,8 +1824,10 @@ def ue4_toolchain_(operator, context, root, armature, mesh):
 
 def repack_resfile(path):
     importlib.reload(resfile)
-    with ResFile(path, 'r') as res:
-        data = res.get_valid_data(recursive=True)
+    resfile.repack(path, recursive=True)
+
 
-    with open(path, "wb") as f:
-        f.write(data)
+def compact_resfile(path, max_bytes=4 << 20):
+    # a bit of defragmentation after each export, instead of a full repack now and then
+    with ResFile(path, 'a', lock=True) as res:
+        res.compact(max_bytes)